@@ -16,6 +16,9 @@ setup(
         'paramiko==2.8.0',
         'backoff==1.8.0',
     ],
+    extras_require={
+        'asyncssh': ['asyncssh>=2.13.1'],
+    },
     entry_points='''
         [console_scripts]
         target-sftp=target_sftp:main
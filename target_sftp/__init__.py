@@ -2,13 +2,35 @@
 import os
 import json
 import argparse
+import collections
+import contextlib
+import errno
 import logging
+import posixpath
+import queue
+import shlex
+import tarfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from target_sftp import client
+import paramiko
+
+from target_sftp import asyncssh_client, client
 
 logger = logging.getLogger("target-sftp")
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
+DEFAULT_BLOCK_SIZE = 1 << 20
+# Thresholds for streaming small files as one tar archive, see upload_tar
+TAR_MIN_FILES = 100
+TAR_MAX_FILE_SIZE = 256 * 1024
+# Upper bound for the adaptive upload window, see UploadWindow
+MAX_PARALLEL = 64
+
+# Read buffers of the streaming upload path, reused across files and workers
+_buffers = queue.LifoQueue()
+
 def load_json(path):
     with open(path) as f:
         return json.load(f)
@@ -38,90 +60,522 @@ def parse_args():
     return args
 
 
+def walk_input(top):
+    '''Walk top like os.walk, but yield dirs and files as os.DirEntry objects.
+    Their type and stat results are cached from the directory scan, so
+    callers can read sizes and mtimes without stat'ing each path again.
+    Each folder also comes with its "/"-separated path relative to top,
+    built while descending instead of with os.path.relpath. Entries that are
+    neither folders nor regular files (FIFOs, sockets, broken symlinks)
+    raise IOError, they cannot be uploaded.
+    '''
+    stack = collections.deque([(top, "")])
+    while stack:
+        path, rel_path = stack.pop()
+        dirs = []
+        files = []
+        others = []
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        dirs.append(entry)
+                    elif entry.is_file():
+                        files.append(entry)
+                    else:
+                        others.append(entry)
+        except OSError:
+            # Unreadable or missing folders are skipped, as os.walk does
+            continue
+        # Raised outside the scan, the handler above would swallow an IOError
+        if others:
+            raise IOError(f'Could not find localFile {others[0].path} !!')
+
+        yield path, rel_path, dirs, files
+        # Pushed in reverse so folders are visited in the same order as os.walk
+        rel_prefix = rel_path + "/" if rel_path else ""
+        for entry in reversed(dirs):
+            if not entry.is_symlink():
+                stack.append((entry.path, rel_prefix + entry.name))
+
+
+def acquire_buffer(size):
+    try:
+        buf = _buffers.get_nowait()
+    except queue.Empty:
+        return bytearray(size)
+    return buf if len(buf) == size else bytearray(size)
+
+
+def release_buffer(buf):
+    _buffers.put(buf)
+
+
+def put_file(sftp_client, local_path, remote_path, confirm=True, block_size=DEFAULT_BLOCK_SIZE,
+             small_file_size=None, file_size=None, pipelined=True, replace=False):
+    '''Upload a local file over a single pipelined SFTP handle.
+    Unlike SFTPClient.put, writes are not acknowledged one by one, so the
+    transfer is not bound by a round trip per 32 KiB block. Files that fit
+    in one SFTP request, or up to small_file_size bytes if that is lower,
+    are read whole and sent with client.write_file; everything else streams
+    through a reused buffer. Pass pipelined=False for servers that mishandle
+    many outstanding writes. With replace, an existing remote file is
+    removed first, pipelined ahead of the OPEN. Returns the number of bytes
+    sent, which may differ from file_size if the file changed meanwhile.
+    '''
+    # if we should overwrite files we should purge existing one before upload
+    removal = client.send_remove(sftp_client, remote_path) if replace else None
+    if file_size is None:
+        file_size = os.path.getsize(local_path)
+    max_small_size = paramiko.SFTPFile.MAX_REQUEST_SIZE
+    if small_file_size is not None:
+        max_small_size = min(small_file_size, max_small_size)
+    if pipelined and file_size <= max_small_size:
+        with open(local_path, "rb") as local_file:
+            data = local_file.read()
+        # The file may have grown since it was stat'ed
+        if len(data) <= paramiko.SFTPFile.MAX_REQUEST_SIZE:
+            client.write_file(sftp_client, remote_path, data, confirm=confirm)
+            if removal is not None:
+                client.finish_remove(removal, remote_path)
+            return len(data)
+
+    size = 0
+    buf = acquire_buffer(block_size)
+    try:
+        # Unbuffered, so paramiko frames slices of our buffer directly instead
+        # of copying them into its own write buffer first
+        with sftp_client.open(remote_path, "wb", bufsize=0) as remote_file, \
+                memoryview(buf) as view, open(local_path, "rb") as local_file:
+            if removal is not None:
+                client.finish_remove(removal, remote_path)
+            remote_file.set_pipelined(pipelined)
+            if hasattr(os, "posix_fadvise"):
+                # Let the kernel read ahead aggressively, the file is
+                # consumed front to back
+                os.posix_fadvise(local_file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            while True:
+                n = local_file.readinto(buf)
+                if not n:
+                    break
+                remote_file.write(view[:n])
+                size += n
+    finally:
+        release_buffer(buf)
+
+    if confirm:
+        remote_size = sftp_client.stat(remote_path).st_size
+        if remote_size != size:
+            raise IOError(f"size mismatch in put!  {remote_size} != {size}")
+    return size
+
+
+def try_stat(sftp_client, remote_path):
+    '''Return the SFTPAttributes of remote_path, or None if it does not exist.'''
+    try:
+        return sftp_client.stat(remote_path)
+    except FileNotFoundError:
+        return None
+
+
+def list_remote_dir(sftp_client, remote_dir):
+    '''Return {name: SFTPAttributes} for remote_dir, or {} if it does not exist.
+    listdir_iter keeps several READDIR requests in flight instead of waiting
+    for each batch of entries, older paramiko falls back to listdir_attr.
+    '''
+    try:
+        if hasattr(sftp_client, "listdir_iter"):
+            entries = sftp_client.listdir_iter(remote_dir)
+        else:
+            entries = sftp_client.listdir_attr(remote_dir)
+        return {entry.filename: entry for entry in entries}
+    except FileNotFoundError:
+        return {}
+
+
+def stat_remote_files(pool, remote_paths, executor=None, created_dirs=()):
+    '''Return {remote_path: SFTPAttributes or None} for many remote files.
+    Folders receiving several files are listed once rather than stat'ing
+    every file, a folder with a single file costs one STAT as before. Each
+    folder is handled with a session acquired from the connection pool, and
+    through executor when given so listings on different sessions overlap.
+    Files in created_dirs, folders made during this run, are known not to
+    exist and cost no round trip.
+    '''
+    stats = {}
+    by_dir = {}
+    for remote_path in remote_paths:
+        remote_dir = posixpath.dirname(remote_path)
+        if remote_dir in created_dirs:
+            stats[remote_path] = None
+        else:
+            by_dir.setdefault(remote_dir, []).append(remote_path)
+
+    def stat_dir(item):
+        remote_dir, paths = item
+        with pool.acquire() as sftp_client:
+            if len(paths) == 1:
+                return {paths[0]: try_stat(sftp_client, paths[0])}
+            entries = list_remote_dir(sftp_client, remote_dir)
+            return {path: entries.get(posixpath.basename(path)) for path in paths}
+
+    for dir_stats in (executor.map if executor else map)(stat_dir, by_dir.items()):
+        stats.update(dir_stats)
+    return stats
+
+
+def ensure_remote_dir(sftp_client, remote_dir, known_dirs=None, created_dirs=None, listed_dirs=()):
+    '''Create remote_dir and any missing parents.
+    The directory is stat'ed first, so existing paths cost a single round
+    trip and only the missing segments are created. Paths in known_dirs are
+    trusted without any round trip, and every path confirmed or created here
+    is added to it. Folders created here are also added to created_dirs; a
+    child of one of those cannot exist yet, so it is created without a stat.
+    The same holds for listed_dirs, folders whose existing children are all
+    in known_dirs already.
+    '''
+    if known_dirs is None:
+        known_dirs = set()
+    if created_dirs is None:
+        created_dirs = set()
+
+    # Walk up until an existing folder is found, then create the missing
+    # segments top-down
+    missing = []
+    path = remote_dir
+    while path not in known_dirs:
+        parent = posixpath.dirname(path)
+        if parent not in created_dirs and parent not in listed_dirs and try_stat(sftp_client, path) is not None:
+            known_dirs.add(path)
+            break
+        missing.append(path)
+        if parent == path:
+            break
+        path = parent
+
+    for path in reversed(missing):
+        try:
+            sftp_client.mkdir(path)
+            created_dirs.add(path)
+            logger.info("Created remote folder %s", path)
+        except IOError as e:
+            # SFTPv3 reports an existing folder as a generic failure without
+            # errno, anything else (e.g. permission denied) is a real error
+            if e.errno not in (errno.EEXIST, None):
+                raise
+        known_dirs.add(path)
+
+
+def ensure_remote_dirs(sftp_client, remote_dirs, known_dirs, created_dirs):
+    '''Create many remote folders, parents first.
+    When an existing folder gets several of them, it is listed once to learn
+    which already exist, and only the others are created, without a stat
+    each. Folders with a single new child keep the cheaper single stat.
+    '''
+    by_parent = {}
+    for remote_dir in remote_dirs:
+        by_parent.setdefault(posixpath.dirname(remote_dir), []).append(remote_dir)
+
+    listed_dirs = set()
+    # Shallow parents first, so each parent is settled before its children
+    for parent in sorted(by_parent, key=lambda path: path.count("/")):
+        children = by_parent[parent]
+        if len(children) > 1 and parent in known_dirs and parent not in created_dirs:
+            existing = list_remote_dir(sftp_client, parent)
+            known_dirs.update(path for path in children if posixpath.basename(path) in existing)
+            listed_dirs.add(parent)
+        for path in children:
+            ensure_remote_dir(sftp_client, path, known_dirs, created_dirs, listed_dirs)
+
+
+def check_remote_files(pool, uploads, config, created_dirs=(), executor=None):
+    '''Apply skip_unchanged and overwrite to the pending uploads.
+    Existing remote files are looked up in bulk with stat_remote_files.
+    Returns the uploads still to do, without unchanged files, and the set of
+    their remote paths that already exist and must be replaced. Each is only
+    removed as part of its own upload, so a failed run never leaves files
+    deleted that it did not get to rewrite.
+    '''
+    skip_unchanged = config.get("skip_unchanged", False)
+    overwrite = config.get("overwrite", False)
+    if not (skip_unchanged or overwrite):
+        return uploads, set()
+
+    remote_stats = stat_remote_files(pool, [remote_path for _, remote_path, _ in uploads],
+                                     executor, created_dirs)
+    pending = []
+    stale = set()
+    for upload in uploads:
+        _, remote_path, local_stat = upload
+        remote_stat = remote_stats.get(remote_path)
+        if remote_stat is not None:
+            # rsync-like incremental runs: a remote copy with the same size and
+            # an mtime no older than the local file is left alone
+            if (skip_unchanged
+                    and remote_stat.st_size == local_stat.st_size
+                    and remote_stat.st_mtime >= int(local_stat.st_mtime)):
+                logger.debug("Skipping unchanged file %s", remote_path)
+                continue
+            if overwrite:
+                stale.add(remote_path)
+        pending.append(upload)
+    return pending, stale
+
+
+class UploadWindow():
+    '''Number of uploads allowed in flight, between min_size and max_size.
+    Every `interval` completions the throughput of that batch is compared to
+    a moving average of earlier batches with a similar mean file size, so a
+    walk moving from large files to small ones is not taken for a slowdown.
+    If the window was fully used and throughput held up it grows by one, if
+    throughput fell below half of the average it is halved, never below
+    min_size. This tracks the bandwidth-delay product of the link above the
+    configured `parallel` without hand-tuning.
+    '''
+    def __init__(self, min_size, max_size, interval=50, clock=time.monotonic):
+        self.size = min_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.interval = interval
+        self.clock = clock
+        self.in_flight = 0
+        self.cond = threading.Condition()
+        # Moving average of bytes/s, keyed by size_class of the batch
+        self.throughput = {}
+        self._reset_batch()
+
+    def _reset_batch(self):
+        self.batch_start = self.clock()
+        self.batch_bytes = 0
+        self.batch_count = 0
+        self.saturated = True
+
+    @staticmethod
+    def size_class(mean_size):
+        # Batches whose mean file sizes are within a factor of 4 compare
+        return int(mean_size).bit_length() // 2
+
+    @contextlib.contextmanager
+    def slot(self, size):
+        with self.cond:
+            while self.in_flight >= self.size:
+                self.cond.wait()
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                self._completed(size)
+                self.cond.notify_all()
+
+    def _completed(self, size):
+        self.batch_bytes += size
+        self.batch_count += 1
+        # Only grow a window that is actually in use
+        self.saturated = self.saturated and self.in_flight + 1 >= self.size
+        if self.batch_count < self.interval:
+            return
+
+        elapsed = max(self.clock() - self.batch_start, 1e-6)
+        throughput = self.batch_bytes / elapsed
+        size_class = self.size_class(self.batch_bytes / self.batch_count)
+        average = self.throughput.get(size_class, throughput)
+        old_size = self.size
+        if throughput < average / 2:
+            self.size = max(self.min_size, self.size // 2)
+            # Measure the smaller window from scratch instead of against the
+            # collapse, which would keep halving it
+            self.throughput[size_class] = throughput
+        else:
+            # Some slack, the average only approaches a steady throughput
+            if self.saturated and throughput >= 0.9 * average:
+                self.size = min(self.max_size, self.size + 1)
+            self.throughput[size_class] = 0.8 * average + 0.2 * throughput
+        if self.size != old_size:
+            logger.debug("Upload window %d -> %d (%.0f bytes/s)", old_size, self.size, throughput)
+        self._reset_batch()
+
+
+def small_file_size(config):
+    # putfo_threshold is the option's former name, still honoured
+    value = config.get("small_file_size", config.get("putfo_threshold"))
+    return int(value) if value is not None else None
+
+
+def upload_file(pool, file_path, remote_path, local_stat, config, block_size=DEFAULT_BLOCK_SIZE,
+                window=None, replace=False):
+    with pool.acquire() as sftp_client:
+        logger.debug("Uploading %s to %s", file_path, remote_path)
+
+        # Sizes are confirmed in bulk by verify_uploads
+        try:
+            with window.slot(local_stat.st_size) if window else contextlib.nullcontext():
+                size = put_file(sftp_client, file_path, remote_path, confirm=False, block_size=block_size,
+                                small_file_size=small_file_size(config),
+                                file_size=local_stat.st_size, pipelined=config.get("pipelined", True),
+                                replace=replace)
+        except (IOError, paramiko.SSHException):
+            logger.info("Failed while trying to upload file with local path %s to %s", file_path, remote_path)
+            raise
+
+        if config.get("skip_unchanged", False):
+            # Carry the local mtime over so the next run can skip this file
+            try:
+                sftp_client.utime(remote_path, (local_stat.st_atime, local_stat.st_mtime))
+            except IOError as e:
+                logger.info("Could not set modification time of %s: %s", remote_path, e)
+    return size
+
+
+def verify_uploads(pool, sent, executor=None):
+    '''Check the remote size of every uploaded file once all are done.
+    `sent` maps remote paths to the bytes upload_file sent for them. Costs
+    one listing per folder (see stat_remote_files) instead of a STAT round
+    trip after each file.
+    '''
+    remote_stats = stat_remote_files(pool, list(sent), executor)
+    for remote_path, size in sent.items():
+        remote_stat = remote_stats.get(remote_path)
+        remote_size = None if remote_stat is None else remote_stat.st_size
+        if remote_size != size:
+            raise IOError(f"size mismatch in put of {remote_path}!  {remote_size} != {size}")
+
+
+def upload_tar(transport, remote_dir, files):
+    '''Stream files as a single tar archive into `tar -x` on the remote host.
+    One exec channel replaces an OPEN/WRITE/CLOSE exchange per file, which
+    dominates when uploading many small files. Requires shell access and tar
+    on the server, returns False if the remote side could not extract them.
+    '''
+    channel = transport.open_session()
+    try:
+        channel.exec_command(f"tar -xf - -C {shlex.quote(remote_dir)}")
+        with channel.makefile("wb") as stream:
+            with tarfile.open(mode="w|", fileobj=stream) as tar:
+                for file_path, arcname in files:
+                    tar.add(file_path, arcname=arcname, recursive=False)
+        channel.shutdown_write()
+        return channel.recv_exit_status() == 0
+    except (paramiko.SSHException, EOFError, OSError) as e:
+        logger.info("Remote tar extraction failed: %s", e)
+        return False
+    finally:
+        channel.close()
+
+
+def upload(config):
+    logger.info("Exporting data...")
+    # Bigger SFTP WRITE requests mean fewer packets and ACKs per file, the
+    # paramiko client applies it when connecting
+    block_size = int(config.get("sftp_block_size", DEFAULT_BLOCK_SIZE))
+
+    # Walk the input before connecting, so an empty export never pays for
+    # the SSH handshake
+    uploads = []
+    rel_dirs = set()
+    for root, rel_root, dirs, files in walk_input(config["input_path"]):
+        # Remote paths are always "/"-separated, so plain concatenation with a
+        # per-folder prefix is enough and skips posixpath.join per entry
+        rel_prefix = rel_root + "/" if rel_root else ""
+        for dir in dirs:
+            rel_dirs.add(rel_prefix + dir.name)
+
+        logger.debug("Root %s: %d dirs, %d files", root, len(dirs), len(files))
+        for file in files:
+            uploads.append((file.path, rel_prefix + file.name, file.stat()))
+
+    if not uploads:
+        logger.info("No files in %s. Skipping...", config["input_path"])
+        return
+
+    if config.get("backend", "paramiko") == "asyncssh":
+        asyncssh_client.upload(config, min(block_size, client.MAX_REQUEST_SIZE), uploads, rel_dirs)
+        return
 
-def upload(args):
-    logger.info(f"Exporting data...")
-    config = args.config
     # Upload all data in input_path to sftp
     ## I don't think preserving directory structure matters, a nice to have, but error-prone
     sftp_conection = client.connection(config)
     sftp_client = sftp_conection.sftp
     output_path = config["path_prefix"]
     export_path = output_path.lstrip("/").rstrip("/")
-    if not export_path:
-        #Set default path to root
-        export_path = "/"
 
+    # Remote paths are relative to the login directory, build them as
+    # absolute paths once so uploads never depend on the session cwd
+    base = sftp_client.normalize(".")
+    known_dirs = {base}
+    created_dirs = set()
     if export_path:
-        for dir in export_path.split("/"):
-            try:
-                # First attempt to create the folder
-                try:
-                    sftp_client.mkdir(dir)
-                except Exception as e:
-                    # logger.exception(f"Failed to create folder {dir} in path {sftp_client.getcwd()}. See details below")
-                    # If it already exists, we ignore
-                    pass
-
-                # Switch into the dir if it exists
-                sftp_client.chdir(dir) #will change if folder already exists
-            except Exception as e:
-                # logger.exception(f"Failed to create folder {dir} in path {sftp_client.getcwd()}. See details below")
-                raise e
-
-    for root, dirs, files in os.walk(config["input_path"]):
-        for dir in dirs:
-            try:
-                sftp_client.mkdir(dir)
-                logger.info(f"Created remote folder {dir}")
-            except:
-                logger.info(f"Remote folder {dir} already exists")
-        if isinstance(files,list) and len(files) == 0:
-            logger.info(f"No files in {root}. Skipping...")
-        
-        logger.info(f"Root {root}. Dirs {dirs}. Files to upload: {files}")
-        for file in files: #upload all files
-            file_path = os.path.join(root, file)
-            stripped_file_path = file_path.replace(config['input_path'] + "/", "",1)
-            prev_cwd = None
-
-            if "/" in stripped_file_path:
-                prev_cwd = sftp_client.getcwd()
-                # Go into the folder
-                sftp_client.chdir(stripped_file_path.split("/")[0])
-
-            # Save the file
-            logger.info(f"Uploading {file} with local path {file_path} to {config['path_prefix']} at {sftp_client.getcwd()}")
-
-            # if we should overwrite files we should purge existing one before upload
-            if config.get("overwrite", False):
-                # Check if the file exists on the remote server
-                try:
-                    sftp_client.stat(file)
-                    file_exists = True
-                except FileNotFoundError:
-                    file_exists = False
-
-                # If the file exists, delete it
-                if file_exists:
-                    sftp_client.remove(file)
-                    logger.info(f"Removed existing file: {file}")
-
-            confirm = config.get("confirm", True)
-            if os.path.isfile(file_path):
-                try:
-                    sftp_client.put(file_path, file, confirm=confirm)
-                except Exception as e:
-                    logger.info(f"Failed while trying to upload file with remote path {file_path} to {config['path_prefix']} at {sftp_client.getcwd()}")
-                    raise Exception(e)
+        base = posixpath.join(base, export_path)
+        ensure_remote_dir(sftp_client, base, known_dirs, created_dirs)
+
+    base_prefix = base.rstrip("/") + "/"
+
+    # Create every folder up front, parents first, so each one costs at most
+    # one stat and one mkdir and workers never race on directory creation
+    ensure_remote_dirs(sftp_client, [base_prefix + rel_dir for rel_dir in rel_dirs], known_dirs, created_dirs)
+
+    uploads = [(file_path, base_prefix + rel_path, local_stat) for file_path, rel_path, local_stat in uploads]
+
+    # Never open more sessions than there are files to upload. `parallel` is
+    # the starting window, it may grow up to `max_parallel` sessions
+    parallel = min(max(1, int(config.get("parallel", 8))), MAX_PARALLEL, len(uploads))
+    max_parallel = min(max(parallel, int(config.get("max_parallel", parallel))), MAX_PARALLEL, len(uploads))
+    # Each worker gets its own SFTP session, so listings and uploads overlap
+    # instead of running one at a time. A single session is just the main one
+    pool = client.ConnectionPool(config, max_parallel, int(config.get("connections", 1)))
+    # Only adapt when there is room above `parallel`, which is never undercut
+    window = UploadWindow(parallel, max_parallel) if max_parallel > parallel else None
+    # Nothing to overlap with a single session, upload without a thread pool
+    executor = ThreadPoolExecutor(max_workers=max_parallel) if max_parallel > 1 else None
+
+    try:
+        with executor or contextlib.nullcontext():
+            # Filter before picking tar candidates, so skip_unchanged spares
+            # small files too
+            uploads, stale = check_remote_files(pool, uploads, config, created_dirs, executor)
+
+            if config.get("tar_small_files", False):
+                max_size = int(config.get("tar_max_file_size", TAR_MAX_FILE_SIZE))
+                small_files = [u for u in uploads if u[2].st_size <= max_size]
+                if len(small_files) >= int(config.get("tar_min_files", TAR_MIN_FILES)):
+                    logger.info("Uploading %d small files as a tar stream to %s", len(small_files), base)
+                    # Every remote path starts with base_prefix, slicing it off gives
+                    # the archive name without posixpath.relpath's split and compare
+                    archived = [(file_path, remote_path[len(base_prefix):]) for file_path, remote_path, _ in small_files]
+                    if upload_tar(sftp_conection.transport, base, archived):
+                        small_files = set(small_files)
+                        uploads = [u for u in uploads if u not in small_files]
+                    else:
+                        logger.info("Falling back to SFTP uploads for small files")
+
+            logger.info("Uploading %d files to %s", len(uploads), base)
+            # Bytes actually sent per remote path, files may change after the walk
+            sent = {}
+            if executor is None:
+                for file_path, remote_path, local_stat in uploads:
+                    sent[remote_path] = upload_file(pool, file_path, remote_path, local_stat, config, block_size,
+                                                    replace=remote_path in stale)
             else:
-                raise IOError(f'Could not find localFile {file_path} !!')
+                futures = {
+                    executor.submit(upload_file, pool, file_path, remote_path, local_stat, config, block_size,
+                                    window, remote_path in stale): remote_path
+                    for file_path, remote_path, local_stat in uploads
+                }
+                try:
+                    for future in as_completed(futures):
+                        sent[futures[future]] = future.result()
+                except Exception:
+                    # Fail fast: drop the queued uploads instead of letting the
+                    # pool drain them all before the error surfaces
+                    for future in futures:
+                        future.cancel()
+                    raise
 
-            if prev_cwd is not None:
-                sftp_client.chdir(prev_cwd)
-        
-    logger.info(f"Closing SFTP connection...")
-    sftp_conection.close()
+            if config.get("confirm", True):
+                verify_uploads(pool, sent, executor)
+    finally:
+        pool.close()
 
 
 def main():
@@ -129,7 +583,7 @@ def main():
     args = parse_args()
 
     # Upload the data
-    upload(args)
+    upload(args.config)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,72 @@
+import asyncio
+import logging
+import os
+import posixpath
+
+logger = logging.getLogger("target-sftp")
+
+
+def connect_kwargs(asyncssh, config):
+    kwargs = {
+        "port": int(config.get("port") or 22),
+        "username": config["username"],
+        "password": config.get("password"),
+        # Same as the paramiko client, which does not verify host keys
+        "known_hosts": None,
+        # None disables compression, an empty tuple keeps the defaults
+        "compression_algs": () if config.get("use_compression", False) else None,
+    }
+    if config.get("private_key"):
+        kwargs["client_keys"] = [asyncssh.import_private_key(config["private_key"])]
+    elif config.get("private_key_file"):
+        kwargs["client_keys"] = [asyncssh.read_private_key(os.path.expanduser(config["private_key_file"]))]
+    return kwargs
+
+
+async def upload_files(asyncssh, config, block_size, uploads, rel_dirs):
+    export_path = config["path_prefix"].lstrip("/").rstrip("/")
+    parallel = max(1, int(config.get("parallel", 8)))
+
+    async with asyncssh.connect(config["host"], **connect_kwargs(asyncssh, config)) as conn:
+        async with conn.start_sftp_client() as sftp:
+            base = await sftp.realpath(".")
+            if export_path:
+                base = posixpath.join(base, export_path)
+            await sftp.makedirs(base, exist_ok=True)
+
+            base_prefix = base.rstrip("/") + "/"
+            # Parents first, so each makedirs only creates its last segment
+            for rel_dir in sorted(rel_dirs, key=lambda path: path.count("/")):
+                await sftp.makedirs(base_prefix + rel_dir, exist_ok=True)
+
+            logger.info("Uploading %d files to %s", len(uploads), base)
+            semaphore = asyncio.Semaphore(parallel)
+
+            async def put(file_path, remote_path):
+                async with semaphore:
+                    logger.debug("Uploading %s to %s", file_path, remote_path)
+                    await sftp.put(file_path, remote_path, block_size=block_size)
+
+            await asyncio.gather(*(put(file_path, base_prefix + rel_path) for file_path, rel_path, _ in uploads))
+
+
+def upload(config, block_size, uploads, rel_dirs):
+    '''Upload the walked input with asyncssh instead of paramiko.
+    uploads holds (local path, remote path relative to path_prefix, stat)
+    tuples and rel_dirs the relative folders to create, as collected by
+    target_sftp.upload. asyncssh keeps many SFTP requests in flight per file,
+    and its crypto runs in C, which lifts paramiko's throughput ceiling. It is
+    an optional dependency, installed with the `asyncssh` extra. Only
+    host, port, username, password, private_key, private_key_file,
+    use_compression, path_prefix, parallel and sftp_block_size apply here;
+    confirm, overwrite, skip_unchanged, tar_small_files, tar_min_files,
+    tar_max_file_size, pipelined, small_file_size (or putfo_threshold),
+    max_parallel, connections and tcp_buffer_size are paramiko-only and
+    ignored.
+    '''
+    try:
+        import asyncssh
+    except ImportError:
+        raise ImportError("The asyncssh backend requires asyncssh, install it with `pip install target-sftp[asyncssh]`")
+
+    asyncio.run(upload_files(asyncssh, config, block_size, uploads, rel_dirs))
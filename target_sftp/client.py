@@ -1,33 +1,85 @@
+import atexit
+import functools
 import logging
 import os
+import queue
 import re
+import socket
 import stat
-import time
+from contextlib import contextmanager
 from io import StringIO
 import backoff
 import paramiko
 import singer
-from paramiko.ssh_exception import AuthenticationException, SSHException
+from paramiko.py3compat import long
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_FSTAT, CMD_HANDLE, CMD_OPEN, CMD_REMOVE, CMD_STATUS,
+                           CMD_WRITE, SFTP_FLAG_CREATE, SFTP_FLAG_TRUNC, SFTP_FLAG_WRITE, SFTPError)
+from paramiko.sftp_attr import SFTPAttributes
+from paramiko.ssh_exception import SSHException
+
+__all__ = ["SFTPConnection", "ConnectionPool", "connection", "new_connection", "write_file", "send_remove",
+           "finish_remove", "MAX_REQUEST_SIZE"]
 
 LOGGER = singer.get_logger()
 
 logging.getLogger("paramiko").setLevel(logging.CRITICAL)
 
+# Large SSH channel window and kernel socket buffers keep high bandwidth-delay
+# links saturated instead of stalling on window adjusts
+WINDOW_SIZE = 2 ** 27
+MAX_PACKET_SIZE = 2 ** 19
+TCP_BUFFER_SIZE = 32 * 1024 * 1024
+KEEPALIVE_INTERVAL = 30
+# paramiko sends 32 KiB WRITEs by default. OpenSSH's sftp-server rejects
+# packets above 256 KiB, keep room for the header
+MAX_REQUEST_SIZE = 255 * 1024
+# paramiko's own prefetch keeps at most this many SFTP requests outstanding
+MAX_IN_FLIGHT = 64
+
+# Open connections keyed by the config they were made from, reused across uploads
+_connections = {}
+
+
+@functools.lru_cache(maxsize=128)
+def compile_pattern(search_pattern):
+    return re.compile(search_pattern)
+
+
 def handle_backoff(details):
     LOGGER.warn(
-        "SSH Connection closed unexpectedly. Waiting {wait} seconds and retrying...".format(**details)
+        "SSH Connection closed unexpectedly. Waiting {wait:.1f} seconds and retrying...".format(**details)
     )
 
 
+def open_socket(host, port, buffer_size=TCP_BUFFER_SIZE):
+    err = None
+    for family, socktype, proto, _, addr in socket.getaddrinfo(host, port, socket.AF_UNSPEC, socket.SOCK_STREAM):
+        sock = socket.socket(family, socktype, proto)
+        try:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            # Buffers must be sized before connect for TCP window scaling to pick them up
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, buffer_size)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, buffer_size)
+            sock.connect(addr)
+            return sock
+        except socket.error as ex:
+            sock.close()
+            err = ex
+    raise SSHException(f"Unable to connect to {host}: {err}")
+
+
 class SFTPConnection():
-    def __init__(self, host, username, password=None, private_key_file=None, private_key=None, port=None):
+    def __init__(self, host, username, password=None, private_key_file=None, private_key=None, port=None, use_compression=False,
+                 request_size=MAX_REQUEST_SIZE, tcp_buffer_size=TCP_BUFFER_SIZE):
         self.host = host
         self.username = username
         self.password = password
         self.port = int(port or 22)
+        self.use_compression = use_compression
+        self.request_size = request_size
+        self.tcp_buffer_size = tcp_buffer_size
         self.key = None
         self.transport = None
-        self.retries = 10
         self.__sftp = None
         if private_key_file:
             key_path = os.path.expanduser(private_key_file)
@@ -35,51 +87,70 @@ class SFTPConnection():
         if private_key:
             key_string = StringIO(private_key)
             self.key = paramiko.RSAKey.from_private_key(key_string)
-    # If connection is snapped during connect flow, retry up to a
-    # minute for SSH connection to succeed. 2^6 + 2^5 + ...
+    # If connection is snapped during connect flow, retry with jittered
+    # exponential waits (2, 4, 8, ... seconds) for SSH connection to succeed
     @backoff.on_exception(
         backoff.expo,
-        (EOFError, ConnectionResetError),
-        max_tries=6,
+        (EOFError, ConnectionResetError, SSHException),
+        max_tries=10,
+        max_time=300,
         on_backoff=handle_backoff,
-        jitter=None,
+        jitter=backoff.full_jitter,
         factor=2)
     def __connect(self):
-        for i in range(self.retries+1):
-            try:
-                LOGGER.info('Creating new connection to SFTP...')
-                self.transport = paramiko.Transport((self.host, self.port))
-                self.transport.use_compression(True)
-                self.transport.connect(username=self.username, password=self.password, hostkey=None, pkey=self.key)
-                self.__sftp = paramiko.SFTPClient.from_transport(self.transport)
-                LOGGER.info('Connection successful')
-                break
-            except (AuthenticationException, SSHException, ConnectionResetError) as ex:
-                self.close()
-                LOGGER.info(f'Connection failed, retrying after {5*i} seconds...')
-                time.sleep(5*i)
-                LOGGER.info('Retrying now')
-                if i >= (self.retries):
-                    raise ex
+        LOGGER.info('Creating new connection to SFTP...')
+        try:
+            sock = open_socket(self.host, self.port, self.tcp_buffer_size)
+            self.transport = paramiko.Transport(sock,
+                                                default_window_size=WINDOW_SIZE,
+                                                default_max_packet_size=MAX_PACKET_SIZE)
+            # Off unless asked for: zlib shrinks text payloads (CSV, JSON)
+            # but single-threaded deflate caps throughput and only burns
+            # CPU on data that is already compressed
+            self.transport.use_compression(self.use_compression)
+            self.transport.connect(username=self.username, password=self.password, hostkey=None, pkey=self.key)
+            self.transport.set_keepalive(KEEPALIVE_INTERVAL)
+            # A class attribute, so it applies to every session opened later
+            paramiko.sftp_file.SFTPFile.MAX_REQUEST_SIZE = min(self.request_size, MAX_REQUEST_SIZE)
+            self.__sftp = paramiko.SFTPClient.from_transport(self.transport)
+        except Exception:
+            self.close()
+            raise
+        LOGGER.info('Connection successful')
 
     @property
     def sftp(self):
-        self.__connect()
+        # Reconnect only when there is no usable session, e.g. after the
+        # server dropped an idle transport
+        if self.__sftp is None or self.transport is None or not self.transport.is_active():
+            self.close()
+            self.__connect()
         return self.__sftp
 
     @sftp.setter
     def sftp(self, sftp):
         self.__sftp = sftp
 
+    def open_sftp(self):
+        return paramiko.SFTPClient.from_transport(self.transport)
+
     def close(self):
-        if self.__sftp:
-            self.__sftp.close()
-        if self.transport:
-            self.transport.close()
+        # Runs on half-open and dropped connections too (failed connect,
+        # reconnect), so a failing session close must not leak the transport
+        try:
+            if self.__sftp:
+                self.__sftp.close()
+        except (EOFError, OSError, SSHException) as ex:
+            LOGGER.info('Error closing SFTP session: %s', ex)
+        finally:
+            self.__sftp = None
+            if self.transport:
+                self.transport.close()
+                self.transport = None
 
     def match_files_for_table(self, files, table_name, search_pattern):
         LOGGER.info("Searching for files for table '%s', matching pattern: %s", table_name, search_pattern)
-        matcher = re.compile(search_pattern)
+        matcher = compile_pattern(search_pattern)
         return [f for f in files if matcher.search(f["filepath"])]
 
     def is_empty(self, file_attr):
@@ -88,10 +159,164 @@ class SFTPConnection():
     def is_directory(self, file_attr):
         return stat.S_ISDIR(file_attr.st_mode)
 
-def connection(config):
+
+class PipelinedRequests():
+    """Send SFTP requests without waiting for each reply.
+
+    Relies on paramiko's internal _async_request/_read_response, the same
+    machinery its file prefetching uses: replies to requests registered
+    with this object are routed back to _async_response.
+    """
+    def __init__(self, sftp_client, max_in_flight=MAX_IN_FLIGHT):
+        self.sftp_client = sftp_client
+        self.max_in_flight = max_in_flight
+        self.pending = set()
+        self.errors = []
+        self.replies = {}
+
+    def request(self, t, *args):
+        self.wait(self.max_in_flight - 1)
+        num = self.sftp_client._async_request(self, t, *args)
+        self.pending.add(num)
+        return num
+
+    def wait(self, max_pending=0):
+        while len(self.pending) > max_pending:
+            self.sftp_client._read_response()
+
+    def _async_response(self, t, msg, num):
+        self.pending.discard(num)
+        if t == CMD_STATUS:
+            try:
+                self.sftp_client._convert_status(msg)
+            except IOError as e:
+                self.errors.append(e)
+        else:
+            self.replies[num] = (t, msg)
+
+
+def write_file(sftp_client, remote_path, data, confirm=True):
+    """Create remote_path holding data, which must fit in a single WRITE.
+
+    OPEN has to complete first to get the handle, then WRITE, FSTAT and
+    CLOSE go out back to back and are answered together: two round trips
+    instead of the four of SFTPClient.putfo with confirm.
+    """
+    flags = SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC
+    t, msg = sftp_client._request(CMD_OPEN, sftp_client._adjust_cwd(remote_path), flags, SFTPAttributes())
+    if t != CMD_HANDLE:
+        raise SFTPError("Expected handle")
+    handle = msg.get_binary()
+
+    requests = PipelinedRequests(sftp_client)
+    requests.request(CMD_WRITE, handle, long(0), data)
+    fstat = requests.request(CMD_FSTAT, handle) if confirm else None
+    requests.request(CMD_CLOSE, handle)
+    requests.wait()
+    if requests.errors:
+        raise requests.errors[0]
+
+    if confirm:
+        t, msg = requests.replies[fstat]
+        if t != CMD_ATTRS:
+            raise SFTPError("Expected attributes")
+        remote_size = SFTPAttributes._from_msg(msg).st_size
+        if remote_size != len(data):
+            raise IOError(f"size mismatch in put!  {remote_size} != {len(data)}")
+
+
+def send_remove(sftp_client, remote_path):
+    """Send a REMOVE of remote_path without waiting for its reply.
+
+    Sent right before the OPEN that recreates the file, its reply comes back
+    ahead of the OPEN's and is collected while paramiko waits for that, so
+    replacing a file costs no extra round trip. Pass the result to
+    finish_remove once the file has been opened.
+    """
+    requests = PipelinedRequests(sftp_client)
+    requests.request(CMD_REMOVE, sftp_client._adjust_cwd(remote_path))
+    return requests
+
+
+def finish_remove(requests, remote_path):
+    # Gone already is as good as removed, and any other failure is harmless:
+    # the OPEN that followed truncates the file anyway
+    requests.wait()
+    for error in requests.errors:
+        if not isinstance(error, FileNotFoundError):
+            LOGGER.info("Could not remove %s before replacing it: %s", remote_path, error)
+
+
+def new_connection(config):
     return SFTPConnection(config['host'],
                           config['username'],
                           password=config.get('password'),
                           private_key_file=config.get('private_key_file'),
                           private_key = config.get('private_key'),
-                          port=config.get('port'))
+                          port=config.get('port'),
+                          use_compression=config.get('use_compression', False),
+                          request_size=int(config.get('sftp_block_size', MAX_REQUEST_SIZE)),
+                          tcp_buffer_size=int(config.get('tcp_buffer_size', TCP_BUFFER_SIZE)))
+
+
+def connection(config):
+    # Every setting new_connection applies is part of the key, a run with
+    # other credentials or tuning must not get an earlier run's transport
+    key = (config['host'], config['username'], int(config.get('port') or 22),
+           config.get('password'), config.get('private_key_file'), config.get('private_key'),
+           bool(config.get('use_compression', False)),
+           int(config.get('sftp_block_size', MAX_REQUEST_SIZE)),
+           int(config.get('tcp_buffer_size', TCP_BUFFER_SIZE)))
+    if key not in _connections:
+        _connections[key] = new_connection(config)
+    return _connections[key]
+
+
+class ConnectionPool():
+    """SFTP sessions shared by upload workers.
+
+    `size` sessions are spread round-robin over `connections` SSH transports,
+    the first being the cached connection() for config, whose main session
+    is one of the pooled ones. Each transport is encrypted and framed by a
+    single paramiko thread, so more than one transport helps when that thread
+    rather than the link is the bottleneck.
+    """
+    def __init__(self, config, size, connections=1):
+        self.sessions = queue.Queue()
+        self.opened = []
+        self.connections = [connection(config)]
+        self.connections += [new_connection(config) for _ in range(min(connections, size) - 1)]
+        try:
+            self.sessions.put(self.connections[0].sftp)
+            for i in range(1, size):
+                conn = self.connections[i % len(self.connections)]
+                # The first session of a transport connects it
+                sftp_client = conn.sftp if i < len(self.connections) else conn.open_sftp()
+                self.opened.append(sftp_client)
+                self.sessions.put(sftp_client)
+        except BaseException:
+            # The caller never gets a pool to close, release what is open
+            self.close()
+            raise
+
+    @contextmanager
+    def acquire(self):
+        sftp_client = self.sessions.get()
+        try:
+            yield sftp_client
+        finally:
+            self.sessions.put(sftp_client)
+
+    def close(self):
+        for sftp_client in self.opened:
+            sftp_client.close()
+        for conn in self.connections[1:]:
+            conn.close()
+
+
+@atexit.register
+def close_connections():
+    for conn in _connections.values():
+        LOGGER.info("Closing SFTP connection...")
+        conn.close()
+    _connections.clear()
@@ -0,0 +1,87 @@
+import collections
+import contextlib
+import threading
+
+from target_sftp import UploadWindow
+
+
+class Workers():
+    '''Drives an UploadWindow on a fake clock the way the worker pool
+    does: every completion is replaced by a new upload while there is room.'''
+    def __init__(self, min_size, max_size):
+        self.now = 0.0
+        self.window = UploadWindow(min_size, max_size, interval=10, clock=lambda: self.now)
+        self.slots = collections.deque()
+
+    def run(self, count, file_size, seconds):
+        '''Complete `count` uploads of `file_size` bytes in `seconds`.'''
+        for _ in range(count):
+            while self.window.in_flight < self.window.size:
+                stack = contextlib.ExitStack()
+                stack.enter_context(self.window.slot(file_size))
+                self.slots.append(stack)
+            self.now += seconds / count
+            self.slots.popleft().close()
+
+
+def test_grows_while_saturated_and_steady():
+    workers = Workers(4, 8)
+    for _ in range(3):
+        workers.run(10, 1 << 20, 1.0)
+    assert workers.window.size == 7
+
+
+def test_never_grows_past_max_size():
+    workers = Workers(4, 6)
+    for _ in range(10):
+        workers.run(10, 1 << 20, 1.0)
+    assert workers.window.size == 6
+
+
+def test_never_shrinks_below_min_size():
+    workers = Workers(4, 8)
+    for _ in range(2):
+        workers.run(10, 1 << 20, 1.0)
+    assert workers.window.size == 6
+    # Halving would give 3, then 1
+    workers.run(10, 1 << 20, 10.0)
+    assert workers.window.size == 4
+    workers.run(10, 1 << 20, 100.0)
+    assert workers.window.size == 4
+
+
+def test_shrinks_on_collapse_for_similar_file_sizes():
+    workers = Workers(2, 16)
+    for _ in range(8):
+        workers.run(10, 1 << 20, 1.0)
+    assert workers.window.size == 10
+    workers.run(10, 1 << 20, 10.0)
+    assert workers.window.size == 5
+
+
+def test_switch_to_small_files_is_not_a_slowdown():
+    workers = Workers(8, 16)
+    for _ in range(10):
+        workers.run(10, 64 << 20, 2.0)
+    size = workers.window.size
+    assert UploadWindow.size_class(4 << 10) != UploadWindow.size_class(64 << 20)
+    # Far fewer bytes/s, but each file finishes much sooner
+    for _ in range(125):
+        workers.run(10, 4 << 10, 0.2)
+        assert workers.window.size >= size
+
+
+def test_slot_waits_for_a_free_slot():
+    window = UploadWindow(1, 1)
+    entered = threading.Event()
+
+    def worker():
+        with window.slot(1):
+            entered.set()
+
+    with window.slot(1):
+        thread = threading.Thread(target=worker)
+        thread.start()
+        assert not entered.wait(0.1)
+    assert entered.wait(1)
+    thread.join()